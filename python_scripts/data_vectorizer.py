@@ -6,10 +6,88 @@ This script transforms JSON documents into vectorized embeddings using
 sentence-transformers model.
 """
 
+import hashlib
 import json
+import logging
+import os
+import sqlite3
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Optional, Union
+from onnx_encoder import OnnxSentenceEncoder, is_mean_pooling_pipeline, mean_pool_normalize
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
+
+# Sentences encoded per chunk, bounding peak memory independently of corpus size
+VECTORIZE_CHUNK_SIZE = 10000
+ENCODE_BATCH_SIZE = 64
+
+# File types whose changes mean the model weights (and so the embeddings) changed
+WEIGHT_FILE_EXTENSIONS = ('.bin', '.safetensors', '.onnx', '.pt', '.pth', '.h5', '.msgpack')
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Fingerprint a tokenizer by its full definition rather than the model path.
+    
+    Checkpoints that share a tokenizer (e.g. encoders being A/B tested)
+    get the same fingerprint, so they can share cached token ids.
+    
+    Args:
+        tokenizer: HuggingFace tokenizer
+        
+    Returns:
+        Hex digest identifying the tokenizer's vocabulary and rules
+    """
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        definition = backend.to_str()
+    else:
+        # Slow tokenizers have no serialized form; fall back to the vocabulary
+        definition = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    return hashlib.blake2b(definition.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def weights_fingerprint(model_path: str) -> str:
+    """
+    Fingerprint the weight files behind a model path or name.
+    
+    Local files and checkpoint directories are fingerprinted by the names,
+    sizes and modification times of their weight files, so retraining or
+    re-exporting in place changes the fingerprint. Hub model names are not
+    on disk and fingerprint as the bare name; clear the embedding cache if
+    such a model is updated on the hub.
+    
+    Args:
+        model_path: ONNX file, local checkpoint directory or hub model name
+        
+    Returns:
+        Hex digest identifying the current weights
+    """
+    if os.path.isfile(model_path):
+        weight_files = [model_path]
+    elif os.path.isdir(model_path):
+        weight_files = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(model_path)
+            for name in names
+            if name.endswith(WEIGHT_FILE_EXTENSIONS)
+        )
+    else:
+        weight_files = []
+    
+    digest = hashlib.blake2b(model_path.encode('utf-8'), digest_size=16)
+    for path in weight_files:
+        stat = os.stat(path)
+        digest.update(f"\0{os.path.relpath(path, model_path)}\0{stat.st_size}\0{stat.st_mtime_ns}".encode('utf-8'))
+    return digest.hexdigest()
 
 
 class DataVectorizer:
@@ -17,16 +95,52 @@ class DataVectorizer:
     A class to handle data vectorization using SentenceTransformer.
     """
     
-    def __init__(self, model_name: str = 'sentence-transformers/all-MiniLM-L6-v2'):
+    def __init__(self, model_name: str = 'sentence-transformers/all-MiniLM-L6-v2',
+                 onnx_model_path: Optional[str] = None, cpu_workers: int = 1,
+                 cache_path: Optional[str] = None, instruction_prefix: str = '',
+                 token_cache_path: Optional[str] = None):
         """
         Initialize the DataVectorizer with a SentenceTransformer model.
         
         Args:
             model_name: Name of the SentenceTransformer model to use
+            onnx_model_path: Exported ONNX model to encode with instead of PyTorch
+            cpu_workers: Number of CPU worker processes to shard encoding across
+                when fewer than two GPUs are available
+            cache_path: SQLite file caching embeddings by content hash, or None to disable.
+                Local weights are fingerprinted into the key; see weights_fingerprint
+            instruction_prefix: Passage-side instruction prepended to every sentence before
+                encoding, e.g. "passage: " for E5 models. Pair it with the matching
+                DocumentSearcher query_prefix (e.g. "query: "). Leave empty for models
+                such as MiniLM that are not instruction-tuned.
+            token_cache_path: SQLite file caching tokenized sentences by content hash,
+                so re-indexing with new weights skips the tokenizer; None to disable
         """
-        self.model = SentenceTransformer(model_name)
+        if onnx_model_path:
+            self.model = OnnxSentenceEncoder(onnx_model_path, model_name)
+        else:
+            self.model = SentenceTransformer(model_name)
+        self.cpu_workers = cpu_workers
+        self.instruction_prefix = instruction_prefix
         self.embeddings = None
+        self.embeddings_path = None
         self.raw_data = None
+        self._pool = None
+        
+        # Embeddings depend on the weights and prefix, so both are part of every cache key
+        model_fingerprint = weights_fingerprint(onnx_model_path or model_name)
+        self._cache_namespace = f"{model_fingerprint}\0{instruction_prefix}".encode('utf-8')
+        self._cache = self._open_cache(cache_path, 'embedding_cache', 'emb') if cache_path else None
+        
+        # Token ids only depend on the tokenizer and truncation length, not on the weights
+        self._token_cache = None
+        if token_cache_path:
+            if is_mean_pooling_pipeline(self.model):
+                tokenizer_id = tokenizer_fingerprint(self.model.tokenizer)
+                self._token_namespace = f"{tokenizer_id}\0{self.model.max_seq_length}".encode('utf-8')
+                self._token_cache = self._open_cache(token_cache_path, 'token_cache', 'ids')
+            else:
+                print("Token cache needs a Transformer + mean Pooling SentenceTransformer; disabled")
     
     def load_json_data(self, json_file_path: str) -> None:
         """
@@ -35,8 +149,8 @@ class DataVectorizer:
         Args:
             json_file_path: Path to the JSON file
         """
-        with open(json_file_path, 'r', encoding='utf-8') as file:
-            self.raw_data = json.load(file)
+        with open(json_file_path, 'rb') as file:
+            self.raw_data = orjson.loads(file.read()) if orjson else json.load(file)
         print(f"Loaded data from {json_file_path}")
     
     def load_json_string(self, json_string: str) -> None:
@@ -46,7 +160,7 @@ class DataVectorizer:
         Args:
             json_string: JSON data as a string
         """
-        self.raw_data = json.loads(json_string)
+        self.raw_data = orjson.loads(json_string) if orjson else json.loads(json_string)
         print("Loaded data from JSON string")
     
     def extract_sentences(self, text_field: str = 'text') -> List[str]:
@@ -70,10 +184,10 @@ class DataVectorizer:
             # List of documents
             for i, doc in enumerate(self.raw_data):
                 if isinstance(doc, dict) and text_field in doc:
-                    print(f"Adding text from document {i+1} (dictionary)")
+                    logger.debug("Adding text from document %d (dictionary)", i + 1)
                     sentences.append(doc[text_field])
                 elif isinstance(doc, str):
-                    print(f"Adding text from document {i+1} (string)")
+                    logger.debug("Adding text from document %d (string)", i + 1)
                     sentences.append(doc)
         elif isinstance(self.raw_data, dict):
             print("Processing single document dictionary")
@@ -82,7 +196,7 @@ class DataVectorizer:
                 print(f"Found nested documents structure with {len(self.raw_data['documents'])} documents")
                 for i, doc in enumerate(self.raw_data['documents']):
                     if isinstance(doc, dict) and text_field in doc:
-                        print(f"Adding text from nested document {i+1}")
+                        logger.debug("Adding text from nested document %d", i + 1)
                         sentences.append(doc[text_field])
             # Single document or dictionary with direct text field
             elif text_field in self.raw_data:
@@ -97,12 +211,24 @@ class DataVectorizer:
         
         return sentences
     
-    def vectorize_sentences(self, sentences: List[str]) -> np.ndarray:
+    def vectorize_sentences(self, sentences: List[str], chunk_size: int = VECTORIZE_CHUNK_SIZE,
+                            output_path: Optional[str] = None) -> np.ndarray:
         """
         Vectorize sentences using SentenceTransformer.
         
+        Sentences are encoded chunk by chunk and written into a preallocated
+        array, so peak memory grows with the chunk size, not the corpus size.
+        With several GPUs (or cpu_workers > 1) each chunk is sharded across a
+        multi-process pool.
+        
+        When output_path is given, that array is a memory-mapped .npy file:
+        chunks are written straight to disk and the file is atomically moved
+        into place once complete, so no separate save pass is needed.
+        
         Args:
             sentences: List of sentences to vectorize
+            chunk_size: Number of sentences encoded per model.encode call
+            output_path: .npy file to write the embeddings to directly, or None
             
         Returns:
             Vectorized embeddings as numpy array
@@ -111,17 +237,240 @@ class DataVectorizer:
             raise ValueError("No sentences provided for vectorization")
         
         print(f"Vectorizing {len(sentences)} sentences...")
-        self.embeddings = self.model.encode(sentences)
+        tmp_path = f"{output_path}.tmp" if output_path else None
+        embeddings = None
+        try:
+            for start in range(0, len(sentences), chunk_size):
+                chunk = self._encode_chunk_cached(sentences[start:start + chunk_size])
+                if embeddings is None:
+                    shape = (len(sentences), chunk.shape[1])
+                    if tmp_path:
+                        embeddings = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+                    else:
+                        embeddings = np.empty(shape, dtype=np.float32)
+                embeddings[start:start + len(chunk)] = chunk
+                print(f"Vectorized {start + len(chunk)}/{len(sentences)} sentences")
+        except Exception:
+            if tmp_path and os.path.exists(tmp_path):
+                del embeddings
+                os.remove(tmp_path)
+            raise
+        finally:
+            if self._pool is not None:
+                self.model.stop_multi_process_pool(self._pool)
+                self._pool = None
+        
+        if tmp_path:
+            embeddings.flush()
+            del embeddings
+            os.replace(tmp_path, output_path)
+            embeddings = np.load(output_path, mmap_mode='r')
+            self.embeddings_path = os.path.abspath(output_path)
+            print(f"Embeddings written to {output_path}")
+        else:
+            self.embeddings_path = None
+        
+        self.embeddings = embeddings
         print(f"Generated embeddings with shape: {self.embeddings.shape}")
         
         return self.embeddings
     
-    def process_json_data(self, text_field: str = 'text') -> np.ndarray:
+    def _pool_devices(self) -> Optional[List[str]]:
+        """
+        Pick the devices to shard encoding across.
+        
+        Returns:
+            One device per worker process, or None to encode in this process
+        """
+        if not isinstance(self.model, SentenceTransformer):
+            return None
+        gpu_count = torch.cuda.device_count()
+        if gpu_count > 1:
+            return [f'cuda:{i}' for i in range(gpu_count)]
+        if gpu_count == 0 and self.cpu_workers > 1:
+            return ['cpu'] * self.cpu_workers
+        return None
+    
+    def _get_pool(self) -> Optional[Dict[str, Any]]:
+        """
+        Start the multi-process pool on first use, so fully cached runs never spawn workers.
+        
+        The pool is stopped at the end of vectorize_sentences.
+        
+        Returns:
+            Multi-process pool from start_multi_process_pool, or None to encode in this process
+        """
+        if self._pool is None:
+            target_devices = self._pool_devices()
+            if target_devices:
+                self._pool = self.model.start_multi_process_pool(target_devices)
+                print(f"Started encoding pool on devices: {target_devices}")
+        return self._pool
+    
+    def _encode_chunk(self, sentences: List[str]) -> np.ndarray:
+        """
+        Encode one chunk of sentences into normalized embeddings.
+        
+        Args:
+            sentences: Sentences in the chunk
+            
+        Returns:
+            Embeddings for the chunk as numpy array
+        """
+        if self.instruction_prefix:
+            sentences = [self.instruction_prefix + sentence for sentence in sentences]
+        pool = self._get_pool()
+        if pool is not None:
+            return self.model.encode_multi_process(sentences, pool, batch_size=ENCODE_BATCH_SIZE,
+                                                   normalize_embeddings=True)
+        if self._token_cache is not None:
+            return self._encode_token_ids(self._tokenize_cached(sentences))
+        return self.model.encode(sentences, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True,
+                                 normalize_embeddings=True, show_progress_bar=False)
+    
+    def _encode_chunk_cached(self, sentences: List[str]) -> np.ndarray:
+        """
+        Encode one chunk, reusing embeddings cached for unchanged sentences.
+        
+        Each sentence is keyed by a BLAKE2b hash of the model and its text; only
+        sentences missing from the cache are encoded, and their embeddings are
+        stored in a single transaction.
+        
+        Args:
+            sentences: Sentences in the chunk
+            
+        Returns:
+            Embeddings for the chunk as numpy array
+        """
+        if self._cache is None:
+            return self._encode_chunk(sentences)
+        
+        keys = [self._cache_key(self._cache_namespace, sentence) for sentence in sentences]
+        rows = self._cache_lookup(self._cache, 'embedding_cache', 'emb', keys)
+        vectors = {key: np.frombuffer(emb, dtype=np.float32) for key, emb in rows.items()}
+        
+        misses = {}
+        for key, sentence in zip(keys, sentences):
+            if key not in vectors and key not in misses:
+                misses[key] = sentence
+        print(f"Embedding cache: {len(sentences) - len(misses)} hits, {len(misses)} to encode")
+        
+        if misses:
+            encoded = self._encode_chunk(list(misses.values())).astype(np.float32, copy=False)
+            vectors.update(zip(misses, encoded))
+            self._cache_store(self._cache, 'embedding_cache', 'emb',
+                              ((key, vector.tobytes()) for key, vector in zip(misses, encoded)))
+        
+        return np.stack([vectors[key] for key in keys])
+    
+    def _tokenize_cached(self, sentences: List[str]) -> List[np.ndarray]:
+        """
+        Tokenize sentences, reusing token ids cached for unchanged sentences.
+        
+        Args:
+            sentences: Sentences to tokenize
+            
+        Returns:
+            One int32 array of unpadded token ids per sentence
+        """
+        # Match SentenceTransformer's Transformer.tokenize, which strips every text
+        sentences = [sentence.strip() for sentence in sentences]
+        keys = [self._cache_key(self._token_namespace, sentence) for sentence in sentences]
+        rows = self._cache_lookup(self._token_cache, 'token_cache', 'ids', keys)
+        token_ids = {key: np.frombuffer(ids, dtype=np.int32) for key, ids in rows.items()}
+        
+        misses = {}
+        for key, sentence in zip(keys, sentences):
+            if key not in token_ids and key not in misses:
+                misses[key] = sentence
+        
+        if misses:
+            batch = self.model.tokenizer(list(misses.values()), padding=False, truncation=True,
+                                         max_length=self.model.max_seq_length)
+            encoded = [np.asarray(ids, dtype=np.int32) for ids in batch['input_ids']]
+            token_ids.update(zip(misses, encoded))
+            self._cache_store(self._token_cache, 'token_cache', 'ids',
+                              ((key, ids.tobytes()) for key, ids in zip(misses, encoded)))
+        
+        return [token_ids[key] for key in keys]
+    
+    def _encode_token_ids(self, token_ids: List[np.ndarray]) -> np.ndarray:
+        """
+        Encode pre-tokenized sentences with the transformer, mean pooling and L2 norm.
+        
+        Sentences are batched in length order to keep padding to a minimum.
+        
+        Args:
+            token_ids: Unpadded token ids per sentence
+            
+        Returns:
+            Normalized embeddings as float32 numpy array
+        """
+        transformer = self.model[0].auto_model.eval()
+        device = self.model.device
+        pad_id = self.model.tokenizer.pad_token_id or 0
+        embeddings = np.empty((len(token_ids), self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        order = np.argsort([len(ids) for ids in token_ids], kind='stable')
+        
+        with torch.inference_mode():
+            for start in range(0, len(order), ENCODE_BATCH_SIZE):
+                batch_order = order[start:start + ENCODE_BATCH_SIZE]
+                max_len = max(len(token_ids[i]) for i in batch_order)
+                input_ids = torch.full((len(batch_order), max_len), pad_id, dtype=torch.long)
+                attention_mask = torch.zeros((len(batch_order), max_len), dtype=torch.long)
+                for row, i in enumerate(batch_order):
+                    input_ids[row, :len(token_ids[i])] = torch.from_numpy(token_ids[i].astype(np.int64))
+                    attention_mask[row, :len(token_ids[i])] = 1
+                
+                input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+                token_embeddings = transformer(input_ids=input_ids, attention_mask=attention_mask)[0]
+                pooled = mean_pool_normalize(token_embeddings, attention_mask.to(token_embeddings.dtype))
+                embeddings[batch_order] = pooled.float().cpu().numpy()
+        
+        return embeddings
+    
+    @staticmethod
+    def _open_cache(path: str, table: str, column: str) -> sqlite3.Connection:
+        """Open an SQLite cache mapping content hashes to blobs in the given table."""
+        connection = sqlite3.connect(path)
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (hash BLOB PRIMARY KEY, {column} BLOB NOT NULL)")
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (hash BLOB PRIMARY KEY)")
+        connection.commit()
+        return connection
+    
+    @staticmethod
+    def _cache_lookup(connection: sqlite3.Connection, table: str, column: str,
+                      keys: List[bytes]) -> Dict[bytes, bytes]:
+        """Fetch the cached blobs for the given hashes through a temp-table join."""
+        with connection:
+            connection.execute("DELETE FROM lookup")
+            connection.executemany("INSERT OR IGNORE INTO lookup (hash) VALUES (?)", ((key,) for key in keys))
+            rows = connection.execute(
+                f"SELECT c.hash, c.{column} FROM {table} c JOIN lookup l ON c.hash = l.hash"
+            ).fetchall()
+        return dict(rows)
+    
+    @staticmethod
+    def _cache_store(connection: sqlite3.Connection, table: str, column: str, rows) -> None:
+        """Insert or replace (hash, blob) rows in a single transaction."""
+        with connection:
+            connection.executemany(f"INSERT OR REPLACE INTO {table} (hash, {column}) VALUES (?, ?)", rows)
+    
+    @staticmethod
+    def _cache_key(namespace: bytes, sentence: str) -> bytes:
+        """Hash a sentence together with a cache namespace such as the model identity."""
+        digest = hashlib.blake2b(namespace, digest_size=32)
+        digest.update(b'\0')
+        digest.update(sentence.encode('utf-8'))
+        return digest.digest()
+    
+    def process_json_data(self, text_field: str = 'text', output_path: Optional[str] = None) -> np.ndarray:
         """
         Process JSON data and return vectorized embeddings.
         
         Args:
             text_field: Name of the field containing text data
+            output_path: .npy file to write the embeddings to directly, or None
             
         Returns:
             Vectorized embeddings as numpy array
@@ -129,7 +478,7 @@ class DataVectorizer:
         print(f"Processing JSON data with text field: {text_field}")
         sentences = self.extract_sentences(text_field)
         print(f"Extracted {len(sentences)} sentences")
-        return self.vectorize_sentences(sentences)
+        return self.vectorize_sentences(sentences, output_path=output_path)
     
     def save_embeddings(self, output_path: str) -> None:
         """
@@ -138,7 +487,9 @@ class DataVectorizer:
         Args:
             output_path: Path to save the embeddings
         """
-        if self.embeddings is not None:
+        if self.embeddings_path is not None and self.embeddings_path == os.path.abspath(output_path):
+            print(f"Embeddings already written to {output_path}")
+        elif self.embeddings is not None:
             np.save(output_path, self.embeddings)
             print(f"Embeddings saved to {output_path}")
         else:
@@ -161,20 +512,19 @@ def main():
     """
     Main function to demonstrate usage.
     """
+    logging.basicConfig(level=logging.INFO)
+    
     # Initialize vectorizer
-    vectorizer = DataVectorizer()
+    vectorizer = DataVectorizer(cache_path='embeddings_cache.sqlite', token_cache_path='tokens_cache.sqlite')
     
     # Load and process JSON data
     try:
         vectorizer.load_json_data('data.json')
-        embeddings = vectorizer.process_json_data('text')
+        embeddings = vectorizer.process_json_data('text', output_path='embeddings.npy')
         
         print(f"Embeddings shape: {embeddings.shape}")
         print(f"First embedding (first 5 dimensions): {embeddings[0][:5]}")
         
-        # Save embeddings
-        vectorizer.save_embeddings('embeddings.npy')
-        
     except FileNotFoundError:
         print("data.json not found. Please create the sample data file first.")
     except Exception as e:
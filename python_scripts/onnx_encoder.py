@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+ONNX Runtime Sentence Encoder
+
+This script exports the SentenceTransformer encoder to ONNX with dynamic int8
+quantization, and provides an encoder that serves the exported model with
+ONNX Runtime on CPU as a drop-in replacement for SentenceTransformer.encode.
+
+It also holds the mean-pooling helpers shared by every encoding path, so
+query and corpus embeddings are always pooled the same way.
+"""
+
+import argparse
+import json
+import os
+import numpy as np
+from typing import List, Optional, Union
+
+try:
+    import onnxruntime
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+except ImportError:  # onnxruntime is optional; only needed for the ONNX encoder
+    onnxruntime = None
+
+
+DEFAULT_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+DEFAULT_MAX_SEQ_LENGTH = 256
+
+# Written next to the exported .onnx files so the encoder matches the export
+ENCODER_CONFIG_NAME = 'encoder_config.json'
+
+
+def is_mean_pooling_pipeline(model) -> bool:
+    """
+    Check that a model is the Transformer -> mean Pooling (-> Normalize) pipeline.
+    
+    Only this pipeline is reproduced by mean_pool_normalize, so the direct
+    encoding paths fall back to model.encode for anything else. Models whose
+    Transformer lowercases input (do_lower_case) are excluded too, since the
+    direct paths call the tokenizer without that preprocessing step.
+    
+    Args:
+        model: Encoder model, e.g. a SentenceTransformer or OnnxSentenceEncoder
+        
+    Returns:
+        True if the model can be encoded with transformer + mean_pool_normalize
+    """
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling, Transformer
+    
+    if not isinstance(model, SentenceTransformer):
+        return False
+    modules = list(model)
+    return (
+        len(modules) >= 2
+        and isinstance(modules[0], Transformer)
+        and isinstance(modules[1], Pooling)
+        and modules[1].get_pooling_mode_str() == 'mean'
+        and all(isinstance(module, Normalize) for module in modules[2:])
+        and not getattr(modules[0], 'do_lower_case', False)
+    )
+
+
+def mean_pool_normalize(token_embeddings, attention_mask):
+    """
+    Mean-pool token embeddings over the attention mask and L2-normalize the result.
+    
+    Works on NumPy arrays and torch tensors alike.
+    
+    Args:
+        token_embeddings: Token embeddings of shape (batch, sequence, dim)
+        attention_mask: Mask of shape (batch, sequence) in the embeddings' float dtype
+        
+    Returns:
+        Normalized sentence embeddings of shape (batch, dim)
+    """
+    mask = attention_mask[..., None]
+    pooled = (token_embeddings * mask).sum(1) / mask.sum(1).clip(min=1e-9)
+    norms = ((pooled * pooled).sum(1) ** 0.5).clip(min=1e-12)
+    return pooled / norms[:, None]
+
+
+class OnnxSentenceEncoder:
+    """
+    A mean-pooling sentence encoder running an exported model on ONNX Runtime.
+    """
+    
+    def __init__(self, onnx_model_path: str, model_name: str = DEFAULT_MODEL_NAME,
+                 max_seq_length: int = DEFAULT_MAX_SEQ_LENGTH):
+        """
+        Initialize the encoder with an exported ONNX model and its tokenizer.
+        
+        When the export directory has an encoder_config.json (written by
+        export_quantized_model), the tokenizer saved there and the recorded
+        max_seq_length are used and the arguments below are ignored.
+        
+        Args:
+            onnx_model_path: Path to the exported (optionally quantized) .onnx file
+            model_name: Name of the model whose tokenizer matches the export
+            max_seq_length: Maximum number of tokens per sentence
+        """
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is required for OnnxSentenceEncoder")
+        from transformers import AutoTokenizer
+        
+        export_dir = os.path.dirname(os.path.abspath(onnx_model_path))
+        config = load_encoder_config(export_dir)
+        if config is not None:
+            model_name = export_dir
+            max_seq_length = config['max_seq_length']
+        else:
+            print(f"Warning: no {ENCODER_CONFIG_NAME} next to {onnx_model_path}; "
+                  f"assuming tokenizer {model_name} with max_seq_length={max_seq_length}")
+        
+        self.session = onnxruntime.InferenceSession(onnx_model_path, providers=['CPUExecutionProvider'])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.max_seq_length = max_seq_length
+        self._input_names = [model_input.name for model_input in self.session.get_inputs()]
+    
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32, **kwargs) -> np.ndarray:
+        """
+        Encode sentences into L2-normalized mean-pooled embeddings.
+        
+        Extra keyword arguments accepted by SentenceTransformer.encode are
+        ignored, since the output is always a normalized numpy array.
+        
+        Args:
+            sentences: Sentence or list of sentences to encode
+            batch_size: Number of sentences per ONNX Runtime call
+        
+        Returns:
+            Embeddings as float32 numpy array
+        """
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size)[0]
+        
+        # SentenceTransformer strips every text before tokenizing
+        sentences = [sentence.strip() for sentence in sentences]
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            features = self.tokenizer(sentences[start:start + batch_size], padding=True, truncation=True,
+                                      max_length=self.max_seq_length, return_tensors='np')
+            inputs = {name: features[name].astype(np.int64) for name in self._input_names}
+            token_embeddings = self.session.run(None, inputs)[0]
+            
+            pooled = mean_pool_normalize(token_embeddings, features['attention_mask'].astype(token_embeddings.dtype))
+            batches.append(pooled.astype(np.float32, copy=False))
+        
+        return np.vstack(batches)
+
+
+def load_encoder_config(export_dir: str) -> Optional[dict]:
+    """
+    Read the encoder settings recorded alongside an ONNX export.
+    
+    Args:
+        export_dir: Directory containing the exported .onnx files
+        
+    Returns:
+        The recorded settings, or None if the export has none
+    """
+    config_path = os.path.join(export_dir, ENCODER_CONFIG_NAME)
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def export_quantized_model(model_name: str, output_dir: str) -> str:
+    """
+    Export a SentenceTransformer encoder to ONNX and quantize its weights to int8.
+    
+    The tokenizer and max_seq_length are saved next to the .onnx files so
+    OnnxSentenceEncoder reproduces the original model's preprocessing.
+    
+    Args:
+        model_name: Name of the SentenceTransformer model to export
+        output_dir: Directory to write model.onnx and model.int8.onnx to
+    
+    Returns:
+        Path to the quantized model
+    """
+    if onnxruntime is None:
+        raise ImportError("onnxruntime is required to quantize the exported model")
+    import torch
+    from sentence_transformers import SentenceTransformer
+    
+    model = SentenceTransformer(model_name, device='cpu')
+    if not is_mean_pooling_pipeline(model):
+        raise ValueError(
+            f"{model_name} is not a Transformer -> mean Pooling (-> Normalize) model; "
+            "OnnxSentenceEncoder cannot reproduce its embeddings"
+        )
+    transformer = model[0].auto_model.eval()
+    dummy = model.tokenizer(['export sentence'], return_tensors='pt')
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in dummy]
+    
+    os.makedirs(output_dir, exist_ok=True)
+    fp32_path = os.path.join(output_dir, 'model.onnx')
+    int8_path = os.path.join(output_dir, 'model.int8.onnx')
+    
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['token_embeddings'] = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            tuple(dummy[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=['token_embeddings'],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+    print(f"Exported ONNX model to {fp32_path}")
+    
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    print(f"Quantized ONNX model saved to {int8_path}")
+    
+    model.tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, ENCODER_CONFIG_NAME), 'w', encoding='utf-8') as file:
+        json.dump({"model_name": model_name, "max_seq_length": model.max_seq_length}, file, indent=2)
+    print(f"Saved tokenizer and {ENCODER_CONFIG_NAME} to {output_dir}")
+    return int8_path
+
+
+def main():
+    """
+    Main function to export and quantize the encoder model.
+    """
+    parser = argparse.ArgumentParser(description='Export the sentence encoder to int8 ONNX')
+    parser.add_argument('--model', default=DEFAULT_MODEL_NAME,
+                       help='SentenceTransformer model name')
+    parser.add_argument('--output-dir', default='onnx',
+                       help='Directory for the exported models (default: onnx)')
+    
+    args = parser.parse_args()
+    export_quantized_model(args.model, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
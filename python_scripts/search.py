@@ -4,15 +4,50 @@ Search Script for Vectorized Documents
 
 This script takes a query string, vectorizes it using the same SentenceTransformer model,
 and finds the best matching documents using cosine similarity.
+
+The corpus embeddings are L2-normalized once and memory-mapped, so cosine
+similarity reduces to a single matrix-vector dot product per query.
 """
 
 import json
 import numpy as np
+import torch
 import argparse
+import os
 import sys
+import threading
+from collections import OrderedDict
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import List, Dict, Tuple
+from onnx_encoder import OnnxSentenceEncoder, is_mean_pooling_pipeline, mean_pool_normalize
+from typing import List, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    orjson = None
+
+try:
+    import faiss
+except ImportError:  # faiss is optional; search falls back to a NumPy scan
+    faiss = None
+
+
+QUERY_CACHE_SIZE = 1024
+
+# Unit-length vectors are quantized to int8 by scaling each component by 127
+INT8_SCALE = 127
+# Rows per block when scoring the int8 matrix, bounding the widened temporary
+QUANTIZED_BLOCK_ROWS = 65536
+
+# Rows copied per transfer when uploading the corpus matrix to the GPU
+GPU_UPLOAD_BLOCK_ROWS = 65536
+
+# Neighbours per node and search beam width for the HNSW graph index
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+
+# Number of characters of document text shown in result previews
+TEXT_PREVIEW_LENGTH = 200
 
 
 class DocumentSearcher:
@@ -20,27 +55,229 @@ class DocumentSearcher:
     A class to search through vectorized documents using cosine similarity.
     """
     
-    def __init__(self, model_name: str = 'sentence-transformers/all-MiniLM-L6-v2'):
+    def __init__(self, model_name: str = 'sentence-transformers/all-MiniLM-L6-v2',
+                 query_cache_size: int = QUERY_CACHE_SIZE, quantize: bool = False,
+                 index_type: Optional[str] = None, onnx_model_path: Optional[str] = None,
+                 compile_encoder: bool = False, query_prefix: str = ''):
         """
         Initialize the DocumentSearcher with a SentenceTransformer model.
         
         Args:
             model_name: Name of the SentenceTransformer model to use
+            query_cache_size: Maximum number of query embeddings kept in the LRU cache
+            quantize: Store the corpus as int8 to cut search memory traffic by 4x
+            index_type: Approximate index to search with ('hnsw'), or None for an exact scan
+            onnx_model_path: Exported ONNX model to encode queries with instead of PyTorch
+            compile_encoder: Compile the query encoder with torch.compile (PyTorch 2.0+)
+            query_prefix: Query-side instruction prepended before encoding, e.g. "query: "
+                for E5 models; pairs with DataVectorizer's instruction_prefix
         """
-        self.model = SentenceTransformer(model_name)
+        if index_type not in (None, 'hnsw'):
+            raise ValueError(f"Unsupported index type: {index_type}")
+        if index_type is not None and faiss is None:
+            raise ImportError("faiss is required for index_type='hnsw'")
+        
+        if onnx_model_path:
+            self.model = OnnxSentenceEncoder(onnx_model_path, model_name)
+        else:
+            self.model = SentenceTransformer(model_name)
+        self._init_query_encoder(compile_encoder)
+        
+        # Lowercasing the cache key is only safe when the tokenizer lowercases anyway
+        self._lowercase_queries = bool(getattr(self.model.tokenizer, 'do_lower_case', False))
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self.query_prefix = query_prefix
+        self.quantize = quantize
+        self.index_type = index_type
         self.embeddings = None
+        self.embeddings_gpu = None
+        self.index = None
         self.document_data = None
         self.document_ids = None
+        self._id_array = None
+        self._doc_array = None
+        self._view_array = None
+    
+    def _init_query_encoder(self, compile_encoder: bool = False) -> None:
+        """
+        Cache the tokenizer and transformer used by the direct query-encoding path.
+        
+        The direct path is only enabled for the Transformer -> mean Pooling
+        (-> Normalize) pipeline it reproduces; other models use model.encode.
+        
+        Args:
+            compile_encoder: Compile the cached transformer with torch.compile
+        """
+        self._fast_encode = is_mean_pooling_pipeline(self.model)
+        if self._fast_encode:
+            self._tokenizer = self.model.tokenizer
+            self._transformer = self.model[0].auto_model.eval()
+            self._max_seq_length = self.model.max_seq_length
+            
+            if compile_encoder and hasattr(torch, 'compile'):
+                if self.model.device.type == 'cuda':
+                    torch.backends.cuda.matmul.allow_tf32 = True
+                self._transformer = torch.compile(self._transformer, mode='reduce-overhead', dynamic=True)
+                
+                # Compilation happens on the first call; do it now rather than inside a request
+                print("Compiling query encoder with torch.compile...")
+                self._encode_queries(['warm up'])
+                print("Compiled query encoder with torch.compile")
+            elif compile_encoder:
+                print("torch.compile requires PyTorch 2.0+; using the eager encoder")
+        elif compile_encoder:
+            print("torch.compile only applies to mean-pooled PyTorch encoders; using model.encode")
+    
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Encode queries into L2-normalized embeddings.
+        
+        Calls the tokenizer and transformer directly, skipping the per-call
+        argument handling and length sorting done by model.encode.
+        
+        Args:
+            queries: Query strings to encode
+            
+        Returns:
+            Normalized embeddings as float32 numpy array of shape (len(queries), dim)
+        """
+        if not self._fast_encode:
+            return self.model.encode(queries, batch_size=len(queries), normalize_embeddings=True)
+        
+        # Match SentenceTransformer's Transformer.tokenize, which strips every text
+        queries = [query.strip() for query in queries]
+        features = self._tokenizer(queries, padding=True, truncation=True,
+                                   max_length=self._max_seq_length, return_tensors='pt')
+        features = {name: tensor.to(self.model.device) for name, tensor in features.items()}
+        
+        with torch.inference_mode():
+            token_embeddings = self._transformer(**features)[0]
+            pooled = mean_pool_normalize(token_embeddings, features['attention_mask'].to(token_embeddings.dtype))
+        
+        return pooled.float().cpu().numpy()
     
     def load_embeddings(self, embeddings_path: str) -> None:
         """
         Load pre-computed embeddings from file.
         
+        The normalized (and, if enabled, int8-quantized) matrix is written once
+        to a file next to the .npy and memory-mapped read-only, so the OS page
+        cache handles residency and forked workers share the same pages. Any
+        faiss index is persisted the same way. Derived files are rebuilt when
+        they are older than the embeddings. On CUDA machines without a faiss
+        index the float matrix is also uploaded to the GPU in float16 for scoring.
+        
         Args:
             embeddings_path: Path to the embeddings .npy file
         """
-        self.embeddings = np.load(embeddings_path)
+        root = os.path.splitext(embeddings_path)[0]
+        normalized_path = f"{root}.normalized.npy"
+        if not self._is_fresh(normalized_path, embeddings_path):
+            embeddings = np.load(embeddings_path, mmap_mode='r').astype(np.float32)
+            
+            # Normalize rows once so per-query cosine similarity is a plain dot product
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True).clip(min=1e-12)
+            self._save_array(normalized_path, embeddings)
+        embeddings = np.load(normalized_path, mmap_mode='r')
+        
+        # With a faiss index every search goes through it; the exact-scan matrices are never scored
+        use_index = self.index_type is not None or (self.quantize and faiss is not None)
+        if self.quantize and not use_index:
+            quantized_path = f"{root}.int8.npy"
+            if not self._is_fresh(quantized_path, normalized_path):
+                # All rows are unit length, so a single global scale suffices
+                self._save_array(quantized_path, np.round(embeddings * INT8_SCALE).astype(np.int8))
+            self.embeddings = np.load(quantized_path, mmap_mode='r')
+            print("Quantized embeddings to int8")
+        else:
+            self.embeddings = embeddings
+            if torch.cuda.is_available() and not use_index:
+                self.embeddings_gpu = self._upload_to_gpu(embeddings)
         print(f"Loaded embeddings with shape: {self.embeddings.shape}")
+        
+        if use_index:
+            self.index = self._load_or_build_index(normalized_path, embeddings)
+    
+    @staticmethod
+    def _upload_to_gpu(embeddings: np.ndarray) -> torch.Tensor:
+        """
+        Copy the normalized corpus to the GPU as float16, one block at a time.
+        
+        float16 keeps more mantissa bits than bfloat16, which matters for
+        scores bounded in [-1, 1], and runs on tensor cores of every generation.
+        
+        Args:
+            embeddings: L2-normalized float32 embeddings, possibly memory-mapped
+            
+        Returns:
+            Embeddings as a float16 CUDA tensor
+        """
+        embeddings_gpu = torch.empty(embeddings.shape, dtype=torch.float16, device='cuda')
+        for start in range(0, len(embeddings), GPU_UPLOAD_BLOCK_ROWS):
+            block = np.array(embeddings[start:start + GPU_UPLOAD_BLOCK_ROWS])
+            embeddings_gpu[start:start + len(block)] = torch.from_numpy(block).to('cuda', dtype=torch.float16)
+        print("Uploaded embeddings to GPU as float16")
+        return embeddings_gpu
+    
+    @staticmethod
+    def _is_fresh(derived_path: str, source_path: str) -> bool:
+        """Check whether a file derived from source_path exists and is up to date."""
+        return (os.path.exists(derived_path)
+                and os.path.getmtime(derived_path) >= os.path.getmtime(source_path))
+    
+    @staticmethod
+    def _save_array(path: str, array: np.ndarray) -> None:
+        """Atomically write an array as .npy so readers never map a partial file."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.save(file, array)
+        os.replace(tmp_path, path)
+    
+    def _load_or_build_index(self, embeddings_path: str, embeddings: np.ndarray):
+        """
+        Load the persisted faiss index for these embeddings, or build and save it.
+        
+        Args:
+            embeddings_path: Path to the normalized embeddings .npy file the index belongs to
+            embeddings: L2-normalized float32 embeddings
+            
+        Returns:
+            A faiss index scoring by inner product
+        """
+        kind = (self.index_type or 'flat') + ('-sq8' if self.quantize else '')
+        index_path = f"{os.path.splitext(embeddings_path)[0]}.{kind}.faiss"
+        
+        if self._is_fresh(index_path, embeddings_path):
+            index = faiss.read_index(index_path)
+            if index.ntotal == len(embeddings):
+                print(f"Loaded {kind} index from {index_path}")
+                return self._configure_index(index)
+        
+        # faiss needs an in-memory contiguous array; this copy only lives during the build
+        embeddings = np.ascontiguousarray(embeddings)
+        dim = embeddings.shape[1]
+        if self.index_type == 'hnsw' and self.quantize:
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        elif self.index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        
+        if not index.is_trained:
+            index.train(embeddings)
+        index.add(embeddings)
+        faiss.write_index(index, index_path)
+        print(f"Built {kind} index and saved it to {index_path}")
+        return self._configure_index(index)
+    
+    @staticmethod
+    def _configure_index(index):
+        """Apply search-time parameters that are not stored with the index."""
+        if hasattr(index, 'hnsw'):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
     
     def load_document_data(self, json_path: str) -> None:
         """
@@ -49,30 +286,110 @@ class DocumentSearcher:
         Args:
             json_path: Path to the JSON file containing document data
         """
-        with open(json_path, 'r', encoding='utf-8') as file:
-            self.document_data = json.load(file)
+        with open(json_path, 'rb') as file:
+            self.document_data = orjson.loads(file.read()) if orjson else json.load(file)
         
         # Extract document IDs and create mapping
         if 'documents' in self.document_data:
-            self.document_ids = [doc['id'] for doc in self.document_data['documents']]
+            documents = self.document_data['documents']
+            self.document_ids = [doc['id'] for doc in documents]
+            
+            # Row-aligned with the embeddings so results are gathered by fancy indexing
+            all_int_ids = all(isinstance(doc_id, int) and not isinstance(doc_id, bool)
+                              for doc_id in self.document_ids)
+            self._id_array = np.array(self.document_ids, dtype=np.int64 if all_int_ids else object)
+            self._doc_array = np.empty(len(documents), dtype=object)
+            self._doc_array[:] = documents
+            self._view_array = np.empty(len(documents), dtype=object)
+            self._view_array[:] = [self._build_document_view(doc) for doc in documents]
             print(f"Loaded {len(self.document_ids)} documents with IDs: {self.document_ids}")
         else:
             print("Warning: No 'documents' key found in JSON data")
     
+    @staticmethod
+    def _build_document_view(doc: Dict) -> Dict:
+        """
+        Build the static, display-ready fields of a document once at load time.
+        
+        Args:
+            doc: Document dictionary from the JSON data
+            
+        Returns:
+            Dictionary with title, category, author, text_preview, date and tags
+        """
+        return {
+            "title": doc.get('title', 'N/A'),
+            "category": doc.get('category', 'N/A'),
+            "author": doc.get('author', 'N/A'),
+            "text_preview": doc['text'][:TEXT_PREVIEW_LENGTH] + "..." if doc.get('text') else 'N/A',
+            "date": doc.get('date', 'N/A'),
+            "tags": doc.get('tags', [])
+        }
+    
     def vectorize_query(self, query: str) -> np.ndarray:
         """
         Vectorize a query string using the same model.
         
+        Embeddings are memoized in a bounded LRU cache keyed by the stripped
+        query (lowercased for uncased tokenizers), so repeated queries skip
+        the model forward pass.
+        
         Args:
             query: Query string to vectorize
             
         Returns:
-            Vectorized query as numpy array
+            Vectorized query as numpy array of shape (1, dim)
         """
-        print(f"Vectorizing query: '{query}'")
-        query_embedding = self.model.encode([query])
-        print(f"Query embedding shape: {query_embedding.shape}")
-        return query_embedding
+        return self.vectorize_queries([query])
+    
+    def vectorize_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Vectorize several query strings with a single model call.
+        
+        Queries found in the LRU cache are served from it; only the misses
+        are encoded, together in one batch.
+        
+        Args:
+            queries: Query strings to vectorize
+            
+        Returns:
+            Vectorized queries as numpy array of shape (len(queries), dim)
+        """
+        cache_keys = [self._query_cache_key(query) for query in queries]
+        vectors = {}
+        with self._query_cache_lock:
+            for cache_key in cache_keys:
+                cached = self._query_cache.get(cache_key)
+                if cached is not None:
+                    self._query_cache.move_to_end(cache_key)
+                    vectors[cache_key] = cached
+        
+        # Encode the cache key itself so a cached vector never depends on which spelling came first
+        misses = {}
+        for cache_key in cache_keys:
+            if cache_key not in vectors and cache_key not in misses:
+                misses[cache_key] = self.query_prefix + cache_key
+        
+        if misses:
+            print(f"Vectorizing {len(misses)} queries: {list(misses.values())}")
+            encoded = self._encode_queries(list(misses.values()))
+            print(f"Query embedding shape: {encoded.shape}")
+            
+            with self._query_cache_lock:
+                for cache_key, query_vector in zip(misses, encoded):
+                    query_vector.flags.writeable = False
+                    vectors[cache_key] = query_vector
+                    self._query_cache[cache_key] = query_vector
+                    self._query_cache.move_to_end(cache_key)
+                while len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.popitem(last=False)
+        
+        return np.stack([vectors[cache_key] for cache_key in cache_keys])
+    
+    def _query_cache_key(self, query: str) -> str:
+        """Normalize a query into its cache key, which is also the text that gets encoded."""
+        query = query.strip()
+        return query.lower() if self._lowercase_queries else query
     
     def find_similar_documents(self, query_embedding: np.ndarray, top_k: int = 5) -> List[Tuple[int, float, Dict]]:
         """
@@ -85,34 +402,92 @@ class DocumentSearcher:
         Returns:
             List of tuples containing (document_id, similarity_score, document_data)
         """
+        top_indices, top_scores = self._find_top_rows(query_embedding, top_k)
+        ids = self._id_array[top_indices].tolist()
+        docs = self._doc_array[top_indices]
+        return list(zip(ids, top_scores, docs))
+    
+    def find_similar_views(self, query_embedding: np.ndarray, top_k: int = 5) -> List[Tuple[int, float, Dict]]:
+        """
+        Find the most similar documents and return their precomputed result views.
+        
+        Args:
+            query_embedding: Vectorized query
+            top_k: Number of top matches to return
+            
+        Returns:
+            List of tuples containing (document_id, similarity_score, document_view)
+        """
+        top_indices, top_scores = self._find_top_rows(query_embedding, top_k)
+        ids = self._id_array[top_indices].tolist()
+        views = self._view_array[top_indices]
+        return list(zip(ids, top_scores, views))
+    
+    def _find_top_rows(self, query_embedding: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the embedding rows most similar to a query.
+        
+        Args:
+            query_embedding: Vectorized query
+            top_k: Number of top matches to return
+            
+        Returns:
+            Tuple of (row indices, similarity scores), best match first
+        """
         if self.embeddings is None:
             raise ValueError("No embeddings loaded. Load embeddings first.")
         
         if self.document_data is None:
             raise ValueError("No document data loaded. Load document data first.")
         
-        # Calculate cosine similarity
-        similarities = cosine_similarity(query_embedding, self.embeddings)[0]
-        print(f"Calculated similarities for {len(similarities)} documents")
+        query_vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
         
-        # Get top-k most similar documents
-        top_indices = np.argsort(similarities)[::-1][:top_k]
-        
-        results = []
-        for idx in top_indices:
-            doc_id = self.document_ids[idx]
-            similarity_score = similarities[idx]
+        if self.index is not None:
+            k = min(top_k, self.index.ntotal)
+            scores, indices = self.index.search(query_vector[np.newaxis, :], k)
+            top_scores, top_indices = scores[0], indices[0]
+        else:
+            similarities = self._compute_similarities(query_vector)
+            print(f"Calculated similarities for {len(similarities)} documents")
             
-            # Find the document data
-            doc_data = None
-            for doc in self.document_data['documents']:
-                if doc['id'] == doc_id:
-                    doc_data = doc
-                    break
+            # Get top-k most similar documents: partial selection, then sort only the winners
+            if top_k >= len(similarities):
+                top_indices = np.argsort(-similarities)
+            else:
+                candidates = np.argpartition(-similarities, top_k - 1)[:top_k]
+                top_indices = candidates[np.argsort(-similarities[candidates])]
+            top_scores = similarities[top_indices]
+        
+        # faiss pads with -1 when it finds fewer than k neighbours
+        valid = top_indices >= 0
+        return top_indices[valid], top_scores[valid]
+    
+    def _compute_similarities(self, query_vector: np.ndarray) -> np.ndarray:
+        """
+        Compute cosine similarity between a unit-length query and every document.
+        
+        Args:
+            query_vector: L2-normalized query vector of shape (dim,)
             
-            results.append((doc_id, similarity_score, doc_data))
+        Returns:
+            Similarity scores as a float32 array of shape (num_documents,)
+        """
+        if self.embeddings_gpu is not None:
+            query_gpu = torch.from_numpy(query_vector).to('cuda', dtype=torch.float16)
+            return (self.embeddings_gpu @ query_gpu).float().cpu().numpy()
         
-        return results
+        if self.embeddings.dtype != np.int8:
+            return self.embeddings @ query_vector
+        
+        # NumPy has no int8 BLAS, so widen one block at a time to keep the temporary small
+        query_q = np.round(query_vector * INT8_SCALE).astype(np.int32)
+        similarities = np.empty(len(self.embeddings), dtype=np.float32)
+        for start in range(0, len(self.embeddings), QUANTIZED_BLOCK_ROWS):
+            block = self.embeddings[start:start + QUANTIZED_BLOCK_ROWS]
+            similarities[start:start + len(block)] = block.astype(np.int32) @ query_q
+        similarities *= 1.0 / INT8_SCALE ** 2
+        return similarities
     
     def search(self, query: str, top_k: int = 5) -> List[Tuple[int, float, Dict]]:
         """
@@ -164,11 +539,23 @@ def main():
                        help='Number of top results to return (default: 5)')
     parser.add_argument('--model', default='sentence-transformers/all-MiniLM-L6-v2',
                        help='SentenceTransformer model name')
+    parser.add_argument('--quantize', action='store_true',
+                       help='Quantize the corpus embeddings to int8 for search')
+    parser.add_argument('--index', choices=['hnsw'], default=None,
+                       help='Search with an approximate faiss index instead of an exact scan')
+    parser.add_argument('--onnx-model', default=None,
+                       help='Path to an exported ONNX model (see onnx_encoder.py) for query encoding')
+    parser.add_argument('--compile', action='store_true',
+                       help='Compile the query encoder with torch.compile')
+    parser.add_argument('--query-prefix', default='',
+                       help='Instruction prepended to the query, e.g. "query: " for E5 models')
     
     args = parser.parse_args()
     
     # Initialize searcher
-    searcher = DocumentSearcher(args.model)
+    searcher = DocumentSearcher(args.model, quantize=args.quantize, index_type=args.index,
+                                onnx_model_path=args.onnx_model, compile_encoder=args.compile,
+                                query_prefix=args.query_prefix)
     
     try:
         # Load embeddings and document data
@@ -4,25 +4,112 @@ Flask Server for Document Search
 
 A simple web server that provides a search endpoint for querying
 vectorized documents using SentenceTransformer embeddings.
+
+Concurrent search requests are coalesced by a background worker so that
+queries arriving within a few milliseconds share one model.encode call.
 """
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from concurrent.futures import Future
 import json
 import os
+import queue
+import threading
+import time
+import numpy as np
 from search import DocumentSearcher
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Global searcher instance
+# Micro-batching settings for query encoding
+MAX_BATCH = 32
+MAX_WAIT_MS = 5
+ENCODE_TIMEOUT_S = 30
+
+# Set SEARCH_COMPILE_ENCODER=1 to torch.compile the query encoder at startup
+COMPILE_ENCODER = os.environ.get('SEARCH_COMPILE_ENCODER', '').lower() in ('1', 'true', 'yes')
+
+# Query-side instruction matching the index's instruction_prefix, e.g. SEARCH_QUERY_PREFIX="query: "
+QUERY_PREFIX = os.environ.get('SEARCH_QUERY_PREFIX', '')
+
+# Global searcher and batcher instances
 searcher = None
+batcher = None
+
+
+class QueryBatcher:
+    """
+    Coalesce concurrent query encodes into a single batched model call.
+    """
+    
+    def __init__(self, document_searcher: DocumentSearcher,
+                 max_batch: int = MAX_BATCH, max_wait_ms: float = MAX_WAIT_MS):
+        """
+        Start the background worker that drains the request queue.
+        
+        Args:
+            document_searcher: Searcher whose model encodes the queries
+            max_batch: Maximum number of queries encoded together
+            max_wait_ms: How long to wait for more queries once one has arrived
+        """
+        self.searcher = document_searcher
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='query-batcher', daemon=True)
+        self._worker.start()
+    
+    def encode(self, query: str, timeout: float = ENCODE_TIMEOUT_S) -> np.ndarray:
+        """
+        Queue a query for encoding and wait for its embedding.
+        
+        Args:
+            query: Query string to vectorize
+            timeout: Seconds to wait before giving up
+            
+        Returns:
+            Vectorized query as numpy array of shape (1, dim)
+        """
+        future = Future()
+        self._queue.put((query, future))
+        return future.result(timeout=timeout)[np.newaxis, :]
+    
+    def _run(self) -> None:
+        """Worker loop: collect a batch, encode it, resolve each waiting request."""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                embeddings = self.searcher.vectorize_queries([query for query, _ in batch])
+            except Exception:
+                # Retry one by one so a single bad query cannot fail the whole batch
+                for query, future in batch:
+                    try:
+                        future.set_result(self.searcher.vectorize_queries([query])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
 
 def initialize_searcher():
     """Initialize the document searcher with default files."""
-    global searcher
+    global searcher, batcher
     try:
-        searcher = DocumentSearcher()
+        searcher = DocumentSearcher(compile_encoder=COMPILE_ENCODER, query_prefix=QUERY_PREFIX)
         
         # Check if default files exist
         embeddings_path = 'embeddings.npy'
@@ -36,6 +123,7 @@ def initialize_searcher():
         # Load embeddings and data
         searcher.load_embeddings(embeddings_path)
         searcher.load_document_data(data_path)
+        batcher = QueryBatcher(searcher)
         
         print("Document searcher initialized successfully!")
         return True
@@ -85,9 +173,9 @@ def search_documents():
         "top_k": 5  // optional, default is 5
     }
     """
-    global searcher
+    global searcher, batcher
     
-    if searcher is None:
+    if searcher is None or batcher is None:
         return jsonify({
             "error": "Document searcher not initialized"
         }), 500
@@ -108,6 +196,11 @@ def search_documents():
                 "error": "No 'query' field provided in request body"
             }), 400
         
+        if not isinstance(query, str):
+            return jsonify({
+                "error": "'query' must be a string"
+            }), 400
+        
         top_k = data.get('top_k', 5)  # Default to 5 if not provided
         
         # Validate top_k
@@ -116,21 +209,17 @@ def search_documents():
                 "error": "'top_k' must be a positive integer"
             }), 400
         
-        # Perform search
-        results = searcher.search(query, top_k)
+        # Perform search, sharing the encoder forward pass with concurrent requests
+        query_embedding = batcher.encode(query)
+        results = searcher.find_similar_views(query_embedding, top_k)
         
-        # Format results for JSON response
+        # Format results for JSON response from the row-aligned views precomputed at load time
         formatted_results = []
-        for doc_id, score, doc_data in results:
+        for doc_id, score, view in results:
             result_item = {
                 "document_id": doc_id,
                 "similarity_score": float(score),
-                "title": doc_data.get('title', 'N/A') if doc_data else 'N/A',
-                "category": doc_data.get('category', 'N/A') if doc_data else 'N/A',
-                "author": doc_data.get('author', 'N/A') if doc_data else 'N/A',
-                "text_preview": doc_data.get('text', 'N/A')[:200] + "..." if doc_data and doc_data.get('text') else 'N/A',
-                "date": doc_data.get('date', 'N/A') if doc_data else 'N/A',
-                "tags": doc_data.get('tags', []) if doc_data else []
+                **view
             }
             formatted_results.append(result_item)
         
@@ -179,5 +268,7 @@ if __name__ == '__main__':
     print('  -H "Content-Type: application/json" \\')
     print('  -d \'{"query": "artificial intelligence", "top_k": 3}\'')
     
+    print("\nFor production, serve with: gunicorn -w 1 --threads 16 --timeout 60 wsgi:app")
+    
     # Run the Flask app
-    app.run(host='0.0.0.0', port=5080, debug=True)
+    app.run(host='0.0.0.0', port=5080, debug=False, threaded=True)
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+WSGI Entry Point for the Document Search Server
+
+Loads the searcher once at import time so every request thread shares a
+single DocumentSearcher and its memory-mapped embeddings. Run with one
+process and many threads, e.g.:
+
+    gunicorn -w 1 --threads 16 --timeout 60 wsgi:app
+
+Avoid --preload: the query batching thread must start inside the worker.
+"""
+
+from server import app, initialize_searcher
+
+if not initialize_searcher():
+    raise RuntimeError("Failed to initialize searcher. Please check your files.")